@@ -6,6 +6,7 @@ import os
 import tqdm
 import json
 import random
+import heapq
 
 model_path = "mlx-community/pixtral-12b-8bit"
 model, processor = load(model_path)
@@ -66,8 +67,7 @@ def generate_prompt(dir, sample=10):
                             )
                     images.append(image)
     if sample:
-        images = sorted(images, key=lambda x: x[0])
-        images = [x[1] for x in images[:sample]]
+        images = [x[1] for x in heapq.nsmallest(sample, images, key=lambda x: x[0])]
 
     prompt = f"Write a title and brief overview of these photos. "
 
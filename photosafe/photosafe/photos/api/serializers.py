@@ -26,8 +26,9 @@ class PhotoSerializer(serializers.ModelSerializer):
 
         photo = Photo.objects.create(**validated_data)
 
-        for version in versions:
-            Version.objects.create(photo=photo, **version)
+        Version.objects.bulk_create(
+            [Version(photo=photo, **version) for version in versions]
+        )
 
         return photo
 
@@ -38,10 +39,27 @@ class PhotoSerializer(serializers.ModelSerializer):
 
         instance = super(PhotoSerializer, self).update(instance, validated_data)
 
+        existing = {v.version: v for v in instance.versions.all()}
+        created = {}
+        updated = {}
+        fields = set()
         for version in versions:
-            Version.objects.update_or_create(
-                photo=instance, version=version["version"], defaults=version
-            )
+            name = version["version"]
+            if name in existing:
+                obj = existing[name]
+                for attr, value in version.items():
+                    setattr(obj, attr, value)
+                updated[name] = obj
+                fields.update(version)
+            elif name in created:
+                for attr, value in version.items():
+                    setattr(created[name], attr, value)
+            else:
+                created[name] = Version(photo=instance, **version)
+
+        Version.objects.bulk_create(created.values())
+        if updated:
+            Version.objects.bulk_update(updated.values(), fields)
 
         return instance
 
@@ -1,10 +1,15 @@
+from django.core.exceptions import ValidationError
+from django.db import transaction
 from django_filters import rest_framework as filters
+from rest_framework import status
+from rest_framework.decorators import action
 from rest_framework.mixins import (
     CreateModelMixin,
     ListModelMixin,
     RetrieveModelMixin,
     UpdateModelMixin,
 )
+from rest_framework.response import Response
 from rest_framework.serializers import LIST_SERIALIZER_KWARGS
 from rest_framework.viewsets import GenericViewSet
 
@@ -18,6 +23,14 @@ from .serializers import (
 )
 
 
+def parse_uuid(value):
+    """Return value as a photo primary key, or None if it isn't a uuid."""
+    try:
+        return Photo._meta.pk.to_python(value)
+    except ValidationError:
+        return None
+
+
 class PhotoFilter(filters.FilterSet):
     albums = filters.CharFilter(lookup_expr="contains")
     date = filters.IsoDateTimeFilter()
@@ -58,6 +71,81 @@ class PhotoViewSet(
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
 
+    @action(detail=False, methods=["post"])
+    def batch(self, request):
+        """
+        Partially update many of the user's photos in one request.
+
+        Expects {"photos": [...]}, each with a "uuid"; photos that don't
+        exist, or whose uuid isn't valid, are reported back in "not_found"
+        rather than created.
+        """
+        photos = None
+        if isinstance(request.data, dict):
+            photos = request.data.get("photos", [])
+
+        if not isinstance(photos, list) or not all(
+            isinstance(data, dict) and "uuid" in data for data in photos
+        ):
+            return Response(
+                {"photos": ["Expected a list of objects with a uuid."]},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        uuids = [parse_uuid(data["uuid"]) for data in photos]
+        existing = {
+            photo.uuid: photo
+            for photo in self.get_queryset().filter(
+                uuid__in=[u for u in uuids if u is not None]
+            )
+        }
+
+        updated, not_found, errors = [], [], {}
+        with transaction.atomic():
+            for data, uuid in zip(photos, uuids):
+                instance = existing.get(uuid)
+                if instance is None:
+                    not_found.append(data["uuid"])
+                    continue
+
+                serializer = self.get_serializer(instance, data=data, partial=True)
+                if serializer.is_valid():
+                    serializer.save()
+                    updated.append(data["uuid"])
+                else:
+                    errors[data["uuid"]] = serializer.errors
+
+        return Response({"updated": updated, "not_found": not_found, "errors": errors})
+
+    @action(detail=False, methods=["post"])
+    def exists_batch(self, request):
+        """
+        Report which of the given uuids already belong to the user.
+
+        Expects {"uuids": [...]}; matches are echoed back as sent, and
+        values that aren't uuids are never matched.
+        """
+        uuids = None
+        if isinstance(request.data, dict):
+            uuids = request.data.get("uuids", [])
+
+        if not isinstance(uuids, list):
+            return Response(
+                {"uuids": ["Expected a list."]}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        parsed = [parse_uuid(u) for u in uuids]
+        existing = set(
+            self.get_queryset()
+            .filter(uuid__in=[u for u in parsed if u is not None])
+            .order_by()
+            .values_list("uuid", flat=True)
+        )
+
+        return Response(
+            {"uuids": [u for u, pk in zip(uuids, parsed) if pk in existing]}
+        )
+
 
 class AlbumViewSet(
     RetrieveModelMixin,
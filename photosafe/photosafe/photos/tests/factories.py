@@ -0,0 +1,30 @@
+import uuid
+
+from django.utils import timezone
+from factory import Faker, LazyFunction, SubFactory
+from factory.django import DjangoModelFactory
+
+from photosafe.photos.models import Photo, Version
+from photosafe.users.tests.factories import UserFactory
+
+
+class PhotoFactory(DjangoModelFactory):
+
+    uuid = LazyFunction(uuid.uuid4)
+    original_filename = Faker("file_name", extension="jpeg")
+    date = LazyFunction(timezone.now)
+    owner = SubFactory(UserFactory)
+
+    class Meta:
+        model = Photo
+
+
+class VersionFactory(DjangoModelFactory):
+
+    photo = SubFactory(PhotoFactory)
+    version = "original"
+    s3_path = Faker("file_path", extension="jpeg")
+    size = 1024
+
+    class Meta:
+        model = Version
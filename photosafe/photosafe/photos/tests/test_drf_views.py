@@ -0,0 +1,143 @@
+import uuid
+
+import pytest
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from photosafe.photos.tests.factories import PhotoFactory
+from photosafe.users.models import User
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def api_client(user: User) -> APIClient:
+    client = APIClient()
+    client.force_authenticate(user)
+    return client
+
+
+class TestPhotoBatch:
+    def post(self, api_client: APIClient, payload):
+        return api_client.post(reverse("api:photo-batch"), payload, format="json")
+
+    def test_updated(self, user: User, api_client: APIClient):
+        photo = PhotoFactory(owner=user)
+
+        response = self.post(
+            api_client, {"photos": [{"uuid": str(photo.uuid), "title": "Updated"}]}
+        )
+
+        assert response.status_code == 200
+        assert response.data == {
+            "updated": [str(photo.uuid)],
+            "not_found": [],
+            "errors": {},
+        }
+        photo.refresh_from_db()
+        assert photo.title == "Updated"
+
+    def test_not_found(self, api_client: APIClient):
+        missing = str(uuid.uuid4())
+
+        response = self.post(api_client, {"photos": [{"uuid": missing}]})
+
+        assert response.status_code == 200
+        assert response.data == {"updated": [], "not_found": [missing], "errors": {}}
+
+    def test_other_users_photo_is_not_found(self, api_client: APIClient):
+        photo = PhotoFactory(title="Theirs")
+
+        response = self.post(
+            api_client, {"photos": [{"uuid": str(photo.uuid), "title": "Mine"}]}
+        )
+
+        assert response.status_code == 200
+        assert response.data["not_found"] == [str(photo.uuid)]
+        photo.refresh_from_db()
+        assert photo.title == "Theirs"
+
+    def test_validation_errors(self, user: User, api_client: APIClient):
+        photo = PhotoFactory(owner=user, width=100)
+        updated = PhotoFactory(owner=user)
+
+        response = self.post(
+            api_client,
+            {
+                "photos": [
+                    {"uuid": str(photo.uuid), "width": "wide"},
+                    {"uuid": str(updated.uuid), "title": "Updated"},
+                ]
+            },
+        )
+
+        assert response.status_code == 200
+        assert response.data["updated"] == [str(updated.uuid)]
+        assert list(response.data["errors"]) == [str(photo.uuid)]
+        assert "width" in response.data["errors"][str(photo.uuid)]
+        photo.refresh_from_db()
+        assert photo.width == 100
+
+    def test_invalid_uuid_is_not_found(self, user: User, api_client: APIClient):
+        photo = PhotoFactory(owner=user)
+
+        response = self.post(
+            api_client,
+            {"photos": [{"uuid": "not-a-uuid"}, {"uuid": str(photo.uuid)}]},
+        )
+
+        assert response.status_code == 200
+        assert response.data["not_found"] == ["not-a-uuid"]
+        assert response.data["updated"] == [str(photo.uuid)]
+
+    @pytest.mark.parametrize(
+        "payload",
+        [
+            {"photos": [{"title": "No uuid"}]},
+            {"photos": ["not an object"]},
+            {"photos": "not a list"},
+            [],
+        ],
+    )
+    def test_bad_input(self, api_client: APIClient, payload):
+        response = self.post(api_client, payload)
+
+        assert response.status_code == 400
+
+
+class TestPhotoExistsBatch:
+    def post(self, api_client: APIClient, payload):
+        return api_client.post(
+            reverse("api:photo-exists-batch"), payload, format="json"
+        )
+
+    def test_echoes_existing_uuids_as_sent(self, user: User, api_client: APIClient):
+        photo = PhotoFactory(owner=user)
+        sent = str(photo.uuid).upper()
+
+        response = self.post(api_client, {"uuids": [sent, str(uuid.uuid4())]})
+
+        assert response.status_code == 200
+        assert response.data == {"uuids": [sent]}
+
+    def test_other_users_photo_is_not_reported(self, api_client: APIClient):
+        photo = PhotoFactory()
+
+        response = self.post(api_client, {"uuids": [str(photo.uuid)]})
+
+        assert response.status_code == 200
+        assert response.data == {"uuids": []}
+
+    def test_invalid_uuids_are_dropped(self, user: User, api_client: APIClient):
+        photo = PhotoFactory(owner=user)
+
+        response = self.post(api_client, {"uuids": ["not-a-uuid", [], str(photo.uuid)]})
+
+        assert response.status_code == 200
+        assert response.data == {"uuids": [str(photo.uuid)]}
+
+    @pytest.mark.parametrize("payload", [{"uuids": "not a list"}, []])
+    def test_bad_input(self, api_client: APIClient, payload):
+        response = self.post(api_client, payload)
+
+        assert response.status_code == 400
@@ -0,0 +1,114 @@
+import pytest
+
+from photosafe.photos.api.serializers import PhotoSerializer
+from photosafe.photos.models import Photo, Version
+from photosafe.photos.tests.factories import PhotoFactory, VersionFactory
+
+pytestmark = pytest.mark.django_db
+
+VERSION_FIELDS = ("version", "s3_path", "filename", "width", "height", "size", "type")
+
+
+def update_or_create_versions(photo: Photo, versions):
+    # the per-version update_or_create loop PhotoSerializer.update replaced
+    for version in versions:
+        Version.objects.update_or_create(
+            photo=photo, version=version["version"], defaults=version
+        )
+
+
+def version_values(photo: Photo):
+    return sorted(photo.versions.values_list(*VERSION_FIELDS))
+
+
+def update(photo: Photo, validated_data):
+    return PhotoSerializer().update(photo, validated_data)
+
+
+class TestPhotoSerializerUpdate:
+    def assert_matches_update_or_create(self, versions, existing=()):
+        expected = PhotoFactory()
+        actual = PhotoFactory()
+        for version in existing:
+            VersionFactory(photo=expected, **version)
+            VersionFactory(photo=actual, **version)
+
+        update_or_create_versions(expected, [dict(v) for v in versions])
+        update(actual, {"versions": [dict(v) for v in versions]})
+
+        assert version_values(actual) == version_values(expected)
+
+    def test_new_version(self):
+        photo = PhotoFactory()
+
+        update(
+            photo,
+            {"versions": [{"version": "original", "s3_path": "a/original.jpeg"}]},
+        )
+
+        assert list(photo.versions.values_list("version", "s3_path")) == [
+            ("original", "a/original.jpeg")
+        ]
+
+    def test_existing_version_is_updated(self):
+        photo = PhotoFactory()
+        version = VersionFactory(photo=photo, version="thumb", s3_path="old", width=10)
+
+        update(photo, {"versions": [{"version": "thumb", "s3_path": "new", "size": 2}]})
+
+        assert photo.versions.count() == 1
+        version.refresh_from_db()
+        assert (version.s3_path, version.size, version.width) == ("new", 2, 10)
+
+    def test_same_version_twice(self):
+        photo = PhotoFactory()
+
+        update(
+            photo,
+            {
+                "versions": [
+                    {"version": "thumb", "s3_path": "first", "width": 1},
+                    {"version": "thumb", "s3_path": "second"},
+                ]
+            },
+        )
+
+        assert list(photo.versions.values_list("s3_path", "width")) == [("second", 1)]
+
+    def test_empty_versions(self):
+        photo = PhotoFactory()
+        VersionFactory(photo=photo, version="original", s3_path="kept")
+
+        update(photo, {"versions": [], "title": "Updated"})
+
+        assert photo.title == "Updated"
+        assert list(photo.versions.values_list("s3_path", flat=True)) == ["kept"]
+
+    @pytest.mark.parametrize(
+        "existing, versions",
+        [
+            ((), [{"version": "original", "s3_path": "a", "size": 1}]),
+            (
+                [{"version": "original", "s3_path": "a", "width": 10}],
+                [{"version": "original", "s3_path": "b", "size": 2}],
+            ),
+            (
+                (),
+                [
+                    {"version": "thumb", "s3_path": "a", "width": 1},
+                    {"version": "thumb", "s3_path": "b"},
+                ],
+            ),
+            (
+                [{"version": "thumb", "s3_path": "a"}],
+                [
+                    {"version": "thumb", "s3_path": "b", "width": 1},
+                    {"version": "thumb", "height": 2},
+                    {"version": "medium", "s3_path": "c"},
+                ],
+            ),
+            ([{"version": "original", "s3_path": "a"}], []),
+        ],
+    )
+    def test_matches_update_or_create(self, existing, versions):
+        self.assert_matches_update_or_create(versions, existing)
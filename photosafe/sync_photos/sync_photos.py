@@ -1,22 +1,34 @@
 import concurrent.futures
-import json
+import dataclasses
 import os
 from datetime import datetime, timedelta, timezone
 
 import boto3
+import orjson
 import osxphotos
 import requests
-from tools import DateTimeEncoder
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
+from tools import clear_photo_field, json_default
+from urllib3.util.retry import Retry
 from dateutil import parser
 
 photos_db = osxphotos.PhotosDB()
 base_path = photos_db.library_path
-s3 = boto3.client("s3", "us-west-2")
+s3 = boto3.client(
+    "s3",
+    "us-west-2",
+    config=Config(
+        max_pool_connections=32, retries={"mode": "adaptive", "max_attempts": 5}
+    ),
+)
 
 bucket = os.environ.get("BUCKET", "jmelloy-photo-backup")
 base_url = os.environ.get("BASE_URL", "http://localhost:8000")
 username = os.environ.get("USERNAME")
 password = os.environ.get("PASSWORD")
+max_workers = int(os.environ.get("MAX_WORKERS", 16))
+batch_size = int(os.environ.get("BATCH_SIZE", 50))
 
 r = requests.post(
     f"{base_url}/auth-token/", json={"username": username, "password": password}
@@ -28,9 +40,44 @@ r = requests.get(f"{base_url}/users/me", headers={"Authorization": f"Token {toke
 r.raise_for_status()
 user = r.json()
 
+# retry everything but POSTs that create records; /api/photos/batch/ only
+# updates existing photos, so it gets its own adapter that may replay a POST
+retry = Retry(
+    total=5,
+    backoff_factor=0.5,
+    status_forcelist=(500, 502, 503, 504),
+    allowed_methods=frozenset({"GET", "HEAD", "OPTIONS", "PUT", "PATCH", "DELETE"}),
+)
+session = requests.Session()
+session.mount(
+    base_url,
+    HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retry),
+)
+session.mount(
+    f"{base_url}/api/photos/batch/",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=max_workers,
+        max_retries=retry.new(allowed_methods=frozenset({"POST"})),
+    ),
+)
+session.headers.update(
+    {"Authorization": f"Token {token}", "Content-Type": "application/json"}
+)
+
 
 # print(server_blocks)
 
+# keys whose values may be absolute paths inside the Photos library
+PATH_FIELDS = frozenset({"library", "path", "path_edited"})
+
+
+def strip_base_path(p):
+    for k in PATH_FIELDS & p.keys():
+        v = p[k]
+        if isinstance(v, str):
+            p[k] = v.removeprefix(base_path)
+
 
 def build_album_list():
     album_keys = [
@@ -64,9 +111,7 @@ def build_album_list():
         ]
 
         for p in album["photos"]:
-            for k, v in p.items():
-                if v and type(v) is str and base_path in v:
-                    p[k] = v.replace(base_path, "")
+            strip_base_path(p)
 
         if a.title in albums:
             raise Exception("Duplicate album name %s" % a.title)
@@ -80,142 +125,151 @@ def get_server_blocks():
         f"{base_url}/photos/blocks", headers={"Authorization": f"Token {token}"}
     )
     r.raise_for_status()
-    return r.json()
+    return {
+        (int(year), int(month), int(day)): vals
+        for year, months in r.json().items()
+        for month, days in months.items()
+        for day, vals in days.items()
+    }
 
 
 total = 0
 
 
-def populate_blocks():
-    global total
-
-    blocks = {}
+def synced_photos():
     for photo in photos_db.photos():
-        dt = photo.date.astimezone(timezone.utc)
         if not photo._info["cloudAssetGUID"]:
             # print(photo.uuid, photo.original_filename, photo.path, photo.path_edited, photo.path_live_photo, photo.path_raw, photo.path_derivatives)
             continue
 
-        total = total + 1
+        yield photo
+
 
-        if dt.year not in blocks:
-            blocks[dt.year] = {}
+def photo_day(photo, utc=timezone.utc):
+    dt = photo.date.astimezone(utc)
+    return dt.year, dt.month, dt.day
 
-        if dt.month not in blocks[dt.year]:
-            blocks[dt.year][dt.month] = {}
 
-        if dt.day not in blocks[dt.year][dt.month]:
-            blocks[dt.year][dt.month][dt.day] = []
+def populate_blocks():
+    global total
 
-        blocks[dt.year][dt.month][dt.day].append(photo)
+    # (count, max date) per day; photos are read again for the days that differ
+    blocks = {}
+    for photo in synced_photos():
+        day = photo_day(photo)
+        date = photo.date_modified or photo.date
+        count, max_date = blocks.get(day, (0, date))
+        blocks[day] = (count + 1, max(max_date, date))
+        total += 1
 
     return blocks
 
 
-def find_discrepancies(blocks, server_blocks):
-    photos_to_process = []
-    for year, months in sorted(blocks.items()):
-        for month, days in sorted(months.items()):
-            for day, photos in sorted(days.items()):
-                count = len(photos)
-                date = max([x.date_modified or x.date for x in photos])
-                vals = (
-                    server_blocks.get(str(year), {})
-                    .get(str(month), {})
-                    .get(str(day), {})
-                )
-                if vals and (
-                    vals["count"] != count
-                    or abs(parser.parse(vals["max_date"]) - date) > timedelta(seconds=3)
-                ):
-                    print(f"discrepancy {year}/{month}/{day}, {vals} vs {count}/{date}")
-                    photos_to_process.extend(blocks[year][month][day])
+# how far a day's newest photo may drift from the server before resyncing
+DISCREPANCY_TOL = timedelta(seconds=3)
 
-    return photos_to_process
 
+def parse_date(value):
+    # /photos/blocks emits ISO 8601 via DjangoJSONEncoder, with "Z" for UTC
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return parser.parse(value)
 
-def sync_photo(photo):
-    p = photo.asdict()
-    p["masterFingerprint"] = photo._info["masterFingerprint"]
-    if not photo._info["cloudAssetGUID"]:
-        return
 
-    p["uuid"] = photo._info["cloudAssetGUID"]
-    for k, v in p.items():
-        if v and type(v) is str and base_path in v:
-            p[k] = v.replace(base_path, "")
-
-    r = requests.patch(
-        f"{base_url}/api/photos/{p['uuid']}/",
-        data=json.dumps(p, cls=DateTimeEncoder),
-        headers={"Content-Type": "application/json", "Authorization": f"Token {token}"},
-    )
+def find_discrepancies(blocks, server_blocks):
+    days = set()
+    for (year, month, day), (count, date) in sorted(blocks.items()):
+        vals = server_blocks.get((year, month, day))
+        if not vals:
+            continue
 
-    if r.status_code == 404:
-        return
-    #     p["id"] = hash_id
-    #     r = requests.post(
-    #         f"{base_url}/api/photos/",
-    #         data=json.dumps(p, cls=DateTimeEncoder),
-    #         headers={
-    #             "Content-Type": "application/json",
-    #             "Authorization": f"Token {token}",
-    #         },
-    #     )
-    # print(r.text)
-    r.raise_for_status()
-    # if r.status_code == 400:
-    #    print(r.json(), p)
+        if vals["count"] == count:
+            if abs(parse_date(vals["max_date"]) - date) <= DISCREPANCY_TOL:
+                continue
+
+        print(f"discrepancy {year}/{month}/{day}, {vals} vs {count}/{date}")
+        days.add((year, month, day))
+
+    return days
+
+
+def discrepant_photos(days):
+    for photo in synced_photos():
+        if photo_day(photo) in days:
+            yield photo
+
+
+# PhotoInfo attributes that map one-to-one onto Photo model fields
+PHOTO_FIELDS = (
+    "original_filename",
+    "date",
+    "description",
+    "title",
+    "keywords",
+    "labels",
+    "albums",
+    "persons",
+    "favorite",
+    "hidden",
+    "latitude",
+    "longitude",
+    "isphoto",
+    "ismovie",
+    "uti",
+    "burst",
+    "live_photo",
+    "date_modified",
+    "portrait",
+    "screenshot",
+    "slow_mo",
+    "time_lapse",
+    "hdr",
+    "selfie",
+    "panorama",
+    "intrash",
+    "height",
+    "width",
+    "orientation",
+)
 
-    # if r.status_code not in (200, 201):
-    #     return
-    # data = r.json()
-    # updates = {}
 
-    # base, ext = os.path.splitext(photo.path)
-    # key = f"{username}/originals/{p['uuid'][0:1]}/{p['uuid']}{ext}"
-    # if photo.path and data["s3_key_path"] is None:
-    #     print(f"Uploading {key} to {bucket}")
-    #     s3.upload_file(photo.path, bucket, key)
-    #     updates["s3_key_path"] = key
+def photo_data(photo):
+    p = {k: getattr(photo, k) for k in PHOTO_FIELDS}
+    p["library"] = photos_db.library_path
+    p["place"] = photo.place.asdict() if photo.place else {}
+    p["exif"] = dataclasses.asdict(photo.exif_info) if photo.exif_info else {}
+    p["score"] = dataclasses.asdict(photo.score) if photo.score else {}
+    p["faces"] = [face.asdict() for face in photo.face_info]
+    p["search_info"] = photo.search_info.asdict() if photo.search_info else {}
 
-    # is_modified = False
-    # if data["date_modified"]:
-    #     modified_date = parser.parse(data["date_modified"])
-    #     is_modified = modified_date and modified_date > photo.date_modified
+    return p
 
-    # if photo.path_edited and (data["s3_edited_path"] is None or is_modified):
-    #     base, ext = os.path.splitext(photo.path_edited)
 
-    #     key = f"{username}/edited/{p['uuid'][0:1]}/{p['uuid']}{ext}"
-    #     print(f"Uploading {key} to {bucket}")
+def photo_payload(photo):
+    if not photo._info["cloudAssetGUID"]:
+        return
 
-    #     s3.upload_file(photo.path_edited, bucket, key)
+    p = photo_data(photo)
+    p["masterFingerprint"] = photo._info["masterFingerprint"]
+    p["uuid"] = photo._info["cloudAssetGUID"]
+    strip_base_path(p)
 
-    #     updates["s3_edited_path"] = key
+    return p
 
-    # if photo.path_derivatives:
-    #     base, ext = os.path.splitext(photo.path_derivatives[-1])
-    #     thumbnail_key = f"{username}/thumbnails/{p['uuid'][0:1]}/{p['uuid']}{ext}"
 
-    #     if (
-    #         data["s3_thumbnail_path"] is None
-    #         or data["s3_thumbnail_path"] != thumbnail_key
-    #         or is_modified
-    #     ):
-    #         print(f"Uploading {thumbnail_key} to {bucket}")
-    #         s3.upload_file(photo.path_derivatives[-1], bucket, thumbnail_key)
-    #         updates["s3_thumbnail_path"] = thumbnail_key
+def send_batch(batch):
+    r = session.post(
+        f"{base_url}/api/photos/batch/",
+        data=orjson.dumps({"photos": batch}, default=json_default),
+    )
+    r.raise_for_status()
 
-    # if updates:
-    #     r = requests.patch(
-    #         f'{base_url}/api/photos/{p["uuid"]}/',
-    #         updates,
-    #         headers={"Authorization": f"Token {token}"},
-    #     )
-    #     r.raise_for_status()
+    rs = r.json()
+    for uuid, errors in rs["errors"].items():
+        print(uuid, errors)
 
-    # return updates
+    return rs
 
 
 def upload_albums():
@@ -227,19 +281,16 @@ def upload_albums():
             "end_date": album_info.end_date,
             "start_date": album_info.start_date,
         }
-        album["photos"] = list(
-            map(
-                lambda photo: photo._info["cloudAssetGUID"] or photo.uuid,
-                album_info.photos,
-            )
-        )
+        album["photos"] = [
+            photo._info["cloudAssetGUID"] or photo.uuid for photo in album_info.photos
+        ]
 
         if not album["photos"]:
             continue
 
         r = requests.put(
             f"{base_url}/api/albums/{album_info.uuid}/",
-            data=json.dumps(album, cls=DateTimeEncoder),
+            data=orjson.dumps(album, default=json_default),
             headers={
                 "Content-Type": "application/json",
                 "Authorization": f"Token {token}",
@@ -249,7 +300,7 @@ def upload_albums():
         if r.status_code == 404:
             r = requests.post(
                 f"{base_url}/api/albums/",
-                data=json.dumps(album, cls=DateTimeEncoder),
+                data=orjson.dumps(album, default=json_default),
                 headers={
                     "Content-Type": "application/json",
                     "Authorization": f"Token {token}",
@@ -262,15 +313,12 @@ def upload_albums():
 
 
 def list_bucket(bucket, prefix=""):
-    key = ""
-    rs = {"IsTruncated": True}
+    paginator = s3.get_paginator("list_objects_v2")
     i = 0
-    while rs["IsTruncated"]:
-        rs = s3.list_objects(Bucket=bucket, Prefix=prefix, Marker=key)
-        if not rs.get("Contents"):
-            return
-        for row in rs.get("Contents", []):
-            key = row["Key"]
+    for page in paginator.paginate(
+        Bucket=bucket, Prefix=prefix, PaginationConfig={"PageSize": 1000}
+    ):
+        for row in page.get("Contents", []):
             i += 1
             yield (
                 row["Key"],
@@ -280,10 +328,32 @@ def list_bucket(bucket, prefix=""):
     print("%d rows returned for %s" % (i, prefix))
 
 
+def delete_batch(bucket, keys):
+    rs = s3.delete_objects(
+        Bucket=bucket,
+        Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+    )
+    return rs.get("Errors", [])
+
+
+def delete_keys(bucket, keys, batch_size=1000, max_workers=16):
+    failed = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(delete_batch, bucket, keys[start : start + batch_size])
+            for start in range(0, len(keys), batch_size)
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            for error in future.result():
+                print(f"Failed to delete {error['Key']}: {error['Message']}")
+                failed.add(error["Key"])
+
+    return failed
+
+
 def cleanup(username):
     photos = {}
     for photo in photos_db.photos():
-        p = photo.asdict()
         uuid = photo._info["cloudAssetGUID"] or photo.uuid
 
         if photo.path:
@@ -303,36 +373,62 @@ def cleanup(username):
 
     rs = list_bucket(bucket=bucket, prefix=username)
 
+    empty = []
+    next_report = 0
     for i, (key, size, mod) in enumerate(rs):
-        if i % 1000 == 0:
+        if i >= next_report:
             print(i, key, size, mod)
+            next_report += 1000
 
         if not size:
             print(f"Deleting {key} for {photos.get(key)}")
-            delete_uuid, k = photos.get(key, (None, None))
+            empty.append(key)
 
-            s3.delete_object(Bucket=bucket, Key=key)
+    failed = delete_keys(bucket, empty)
 
-            if delete_uuid:
-                r = requests.patch(
-                    f"{base_url}/api/photos/{uuid}/",
-                    {k: None},
-                    headers={"Authorization": f"Token {token}"},
-                )
-                r.raise_for_status()
+    for key in empty:
+        delete_uuid, k = photos.get(key, (None, None))
+        if delete_uuid and key not in failed:
+            clear_photo_field(session, base_url, delete_uuid, k)
 
 
 if __name__ == "__main__":
     blocks = populate_blocks()
     server_blocks = get_server_blocks()
-    photos = find_discrepancies(blocks, server_blocks=server_blocks)
+    days = find_discrepancies(blocks, server_blocks=server_blocks)
+    photos = discrepant_photos(days)
+
+    print("total", total)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # at most max_workers batches in flight, so payloads aren't queued for
+        # the whole library and a failed batch raises as soon as it's seen
+        pending = set()
+        batch = []
+        checked = 0
+        updated = 0
+        for photo in photos:
+            checked += 1
+            p = photo_payload(photo)
+            if p:
+                batch.append(p)
+
+            if len(batch) >= batch_size:
+                pending.add(executor.submit(send_batch, batch))
+                batch = []
+
+            if len(pending) >= max_workers:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    updated += len(future.result()["updated"])
 
-    print("total", total, "to process:", len(photos))
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        futures = executor.map(sync_photo, photos)
+        if batch:
+            pending.add(executor.submit(send_batch, batch))
 
-        results = list(futures)
+        for future in concurrent.futures.as_completed(pending):
+            updated += len(future.result()["updated"])
 
-        print(len(results), "checked", len(list(filter(None, results))), "uploaded")
+        print(checked, "checked", updated, "updated")
 
     # upload_albums()
@@ -0,0 +1,34 @@
+import orjson
+import requests
+from requests.adapters import BaseAdapter
+from tools import clear_photo_field
+
+
+class RecordingAdapter(BaseAdapter):
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        response = requests.Response()
+        response.status_code = 200
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def test_clear_photo_field_sends_null_as_json():
+    adapter = RecordingAdapter()
+    session = requests.Session()
+    session.mount("http://testserver", adapter)
+
+    clear_photo_field(session, "http://testserver", "abc", "s3_key_path")
+
+    (request,) = adapter.requests
+    assert request.method == "PATCH"
+    assert request.url == "http://testserver/api/photos/abc/"
+    assert request.headers["Content-Type"] == "application/json"
+    assert orjson.loads(request.body) == {"s3_key_path": None}
@@ -3,6 +3,7 @@ import datetime
 from hashlib import md5
 import boto3
 import botocore.exceptions
+import orjson
 
 s3 = boto3.client("s3", "us-west-2")
 
@@ -14,6 +15,23 @@ class DateTimeEncoder(JSONEncoder):
             return obj.isoformat()
 
 
+# default hook for orjson.dumps, mirroring DateTimeEncoder
+def json_default(obj):
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return obj.isoformat()
+
+
+def clear_photo_field(session, base_url, uuid, field):
+    # sent as JSON: requests drops None values from form-encoded data
+    r = session.patch(
+        f"{base_url}/api/photos/{uuid}/",
+        data=orjson.dumps({field: None}),
+        headers={"Content-Type": "application/json"},
+    )
+    r.raise_for_status()
+    return r
+
+
 def calc_etag(data, partsize=8388608):
     if len(data) < partsize:
         return f'"{md5(data).hexdigest()}"'
@@ -25,24 +43,19 @@ def calc_etag(data, partsize=8388608):
 
 
 def list_bucket(bucket, prefix=""):
-    key = ""
-    rs = {"IsTruncated": True}
+    paginator = s3.get_paginator("list_objects_v2")
     total = 0
-    while rs["IsTruncated"]:
-        rs = s3.list_objects(Bucket=bucket, Prefix=prefix, Marker=key)
-        if not rs.get("Contents"):
-            return
-
-        for row in rs.get("Contents", []):
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        contents = page.get("Contents", [])
+        for row in contents:
             yield row["Key"], row.get("Size", 0), row["ETag"]
-        else:
-            key = row["Key"]
-            total += len(rs.get("Contents", []))
+        total += len(contents)
     print("%d rows returned for s3://%s/%s" % (total, bucket, prefix))
 
 
 def sum_bucket(bucket, print_every=1000):
     d = {}
+    next_report = 0
     for i, (key, size, etag) in enumerate(list_bucket(bucket)):
         directory_name = "/".join(key.split("/")[0:-1]) + "/" if "/" in key else ""
         (sz, items) = d.get(directory_name, (0, 0))
@@ -50,11 +63,16 @@ def sum_bucket(bucket, print_every=1000):
         items += 1
         d[directory_name] = (sz, items)
 
-        if i % print_every == 0:
+        if i >= next_report:
             print(" --", i, directory_name, d[directory_name])
+            next_report += print_every
 
-    for k, v in sorted(d.items(), key=lambda x: x[1][0], reverse=True):
-        print(f"{k:15} {v[1]:,} {v[0] / 1024 ** 3:.3}")
+    print(
+        "\n".join(
+            f"{k:15} {v[1]:,} {v[0] / 1024 ** 3:.3}"
+            for k, v in sorted(d.items(), key=lambda x: x[1][0], reverse=True)
+        )
+    )
 
     return d
 
@@ -63,6 +81,6 @@ def head(key, bucket="jmelloy-photo-backup"):
     try:
         return s3.head_object(Key=key, Bucket=bucket)
     except botocore.exceptions.ClientError as ce:
-        if "404" in str(ce):
+        if ce.response["Error"]["Code"] in ("404", "NoSuchKey"):
             return False
         raise
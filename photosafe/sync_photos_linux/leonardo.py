@@ -1,16 +1,20 @@
 import argparse
+import concurrent.futures
 import datetime
+import functools
 import io
-import json
 import logging
 import os
 from copy import copy
 from urllib.parse import urlparse
 
 import boto3
+import orjson
 import requests
+from botocore.config import Config
 from PIL import Image
-from tools import DateTimeEncoder, list_bucket
+from requests.adapters import HTTPAdapter
+from tools import existing_uuids, json_default, list_bucket
 from tqdm import tqdm
 
 logging.basicConfig(
@@ -21,7 +25,25 @@ logging.basicConfig(
 logger = logging.getLogger()
 
 
+def parse_created_at(value):
+    # fromisoformat before 3.11 only takes 3 or 6 fractional digits, and
+    # Leonardo drops trailing zeros ("...:30.37"), so fall back to strptime
+    value = value.rstrip("Z")
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f")
+
+
 class GeneratedImage:
+    __slots__ = (
+        "url",
+        "nsfw",
+        "id",
+        "like_count",
+        "generated_image_variation_generics",
+    )
+
     def __init__(self, data):
         self.url = data.get("url")
         self.nsfw = data.get("nsfw")
@@ -33,6 +55,27 @@ class GeneratedImage:
 
 
 class Generation:
+    __slots__ = (
+        "data",
+        "generated_images",
+        "model_id",
+        "prompt",
+        "negative_prompt",
+        "image_height",
+        "image_width",
+        "inference_steps",
+        "seed",
+        "is_public",
+        "scheduler",
+        "sd_version",
+        "status",
+        "preset_style",
+        "init_strength",
+        "guidance_scale",
+        "id",
+        "created_at",
+    )
+
     def __init__(self, data):
         self.data = data
 
@@ -55,14 +98,15 @@ class Generation:
         self.init_strength = data.get("initStrength")
         self.guidance_scale = data.get("guidanceScale")
         self.id = data.get("id")
-        self.created_at = datetime.datetime.strptime(
-            data.get("createdAt"), "%Y-%m-%dT%H:%M:%S.%f"
-        )
+        self.created_at = parse_created_at(data.get("createdAt"))
 
 
 s3 = boto3.client(
     "s3",
     "us-west-2",
+    config=Config(
+        max_pool_connections=32, retries={"mode": "adaptive", "max_attempts": 5}
+    ),
 )
 
 bucket = os.environ.get("BUCKET", "jmelloy-photo-backup")
@@ -89,9 +133,15 @@ session.headers.update({"Authorization": f"Token {token}"})
 session.headers.update({"Content-Type": f"application/json"})
 
 leonardo_session = requests.Session()
+leonardo_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
 leonardo_session.headers.update({"Authorization": f"Bearer {leonardo_key}"})
 leonardo_session.headers.update({"Accept": f"application/json"})
 
+cdn_session = requests.Session()
+cdn_session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
+upload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
 user_details = {
     "user_details": [
         {
@@ -118,12 +168,12 @@ def wrap(session, url, data={}, method="POST"):
     elif method.upper() == "POST":
         resp = session.post(
             f"{url}",
-            data=json.dumps(data, cls=DateTimeEncoder),
+            data=orjson.dumps(data, default=json_default),
         )
     elif method.upper() == "PUT":
         resp = session.put(
             f"{url}",
-            data=json.dumps(data, cls=DateTimeEncoder),
+            data=orjson.dumps(data, default=json_default),
         )
     elif method.upper() == "DELETE":
         resp = session.delete(
@@ -132,14 +182,15 @@ def wrap(session, url, data={}, method="POST"):
     elif method.upper() == "PATCH":
         resp = session.patch(
             f"{url}",
-            data=json.dumps(data, cls=DateTimeEncoder),
+            data=orjson.dumps(data, default=json_default),
         )
 
     end = datetime.datetime.now()
 
     logger.info(f""" --> {resp.status_code} - {end - start}""")
 
-    logger.debug(f"{json.dumps(resp.json(), indent=2)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(orjson.dumps(resp.json(), option=orjson.OPT_INDENT_2).decode())
 
     if resp.status_code > 205:
         logger.warning(resp.text)
@@ -148,6 +199,7 @@ def wrap(session, url, data={}, method="POST"):
     return resp.json(), resp
 
 
+@functools.lru_cache(maxsize=128)
 def get_model(id: str) -> dict:
     url = f"https://cloud.leonardo.ai/api/rest/v1/models/{id}"
 
@@ -167,47 +219,62 @@ def generations(offset, limit, user_id="278a9059-6820-4882-aec1-a02d0c7867af") -
 def iteration_generations():
     offset = 0
     limit = 100
-    while True:
-        response = generations(offset, limit)
-        if len(response["generations"]) == 0:
-            break
-        for generation in response["generations"]:
-            yield generation
-        offset += limit
+    # fetch the next page while the caller works through the current one
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        page = executor.submit(generations, offset, limit)
+        while True:
+            response = page.result()
+            if len(response["generations"]) == 0:
+                break
+            offset += limit
+            page = executor.submit(generations, offset, limit)
+
+            # one existence check for every image on the page
+            known = existing_uuids(
+                session,
+                base_url,
+                [
+                    image["id"]
+                    for generation in response["generations"]
+                    for image in generation.get("generated_images", [])
+                ],
+            )
+            for generation in response["generations"]:
+                yield generation, known
 
 
-def upload_to_s3(url, bucket_name, object_key, objects={}):
-    response = requests.get(url)
-    image_data = response.content
-    image = Image.open(io.BytesIO(image_data))
+def fetch(url):
+    response = cdn_session.get(url)
+    response.raise_for_status()
+    return response.content
 
+
+def upload_to_s3(image_data, bucket_name, object_key, objects={}):
     if not object_key in objects:
         s3.put_object(Body=image_data, Bucket=bucket_name, Key=object_key)
 
-    return image, len(image_data)
-
+    return len(image_data)
 
-def upload_and_resize(url, bucket_name, object_key, objects={}):
-    response = requests.get(url)
-    image_data = response.content
 
+def upload_and_resize(image_data, bucket_name, object_key, objects={}):
     image = Image.open(io.BytesIO(image_data))
     image.thumbnail((480, 480))
 
     output = io.BytesIO()
     image.save(output, format="JPEG")
-    output.seek(0)
-    size = len(output.getvalue())
+    size = output.getbuffer().nbytes
     output.seek(0)
     if not object_key in objects:
-        s3.upload_fileobj(output, bucket_name, object_key)
+        s3.put_object(Body=output, Bucket=bucket_name, Key=object_key)
 
     return image, size
 
 
 if __name__ == "__main__":
     s3_keys = {}
+    max_cached_months = 12
     existing = 0
+    stop_reached = False
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--stop-after", type=int, default=5)
@@ -223,10 +290,8 @@ if __name__ == "__main__":
     logger.setLevel(getattr(logging, args.log_level.upper()))
     i = 0
 
-    models = {}
-
     os.makedirs(username, exist_ok=True)
-    for gen in iteration_generations():
+    for gen, known in iteration_generations():
         generation = Generation(gen)
 
         images = generation.generated_images
@@ -234,38 +299,33 @@ if __name__ == "__main__":
         metadata = copy(gen)
         metadata.pop("generated_images")
 
+        model = get_model(generation.model_id) if generation.model_id else {}
+        metadata["model"] = model.get("custom_models_by_pk", {}).get("name", "Unknown")
+
+        dt = generation.created_at.strftime("%Y/%m/%d")
+
+        month = dt[0:7]
+        existing_s3_objects = s3_keys.get(month)
+        if existing_s3_objects is None:
+            existing_s3_objects = {
+                key: size
+                for key, size, _ in list_bucket(
+                    s3, bucket=bucket, prefix=f"{username}/{month}/"
+                )
+            }
+            s3_keys[month] = existing_s3_objects
+            for key in list(s3_keys):
+                if key > month:
+                    del s3_keys[key]
+            if len(s3_keys) > max_cached_months:
+                s3_keys.pop(next(iter(s3_keys)))
+            # print(sys.getsizeof(), "bytes")
+
+
         for image in images:
             i += 1
 
             print(image.id, generation.created_at)
-            dt = generation.created_at.strftime("%Y/%m/%d")
-
-            existing_s3_objects = s3_keys.get(dt)
-            if not existing_s3_objects:
-                existing_s3_objects = {
-                    x[0]: x[1]
-                    for x in list_bucket(
-                        s3,
-                        bucket=bucket,
-                        prefix=os.path.join(os.path.join(username, dt)),
-                    )
-                }
-                s3_keys[dt] = existing_s3_objects
-                for key in list(s3_keys):
-                    if key[0:7] > dt[0:7]:
-                        del s3_keys[key]
-                # print(sys.getsizeof(), "bytes")
-
-            exif = metadata
-            if generation.model_id and generation.model_id not in models:
-                model = get_model(generation.model_id)
-                models[generation.model_id] = model
-
-            exif["model"] = (
-                models.get(generation.model_id, {})
-                .get("custom_models_by_pk", {})
-                .get("name", "Unknown")
-            )
 
             data = {
                 "uuid": image.id,
@@ -276,7 +336,7 @@ if __name__ == "__main__":
                 "width": generation.image_width,
                 "height": generation.image_height,
                 "title": generation.prompt,
-                "exif": exif,
+                "exif": metadata,
                 "library": "leonardo",
                 "isphoto": True,
             }
@@ -288,7 +348,16 @@ if __name__ == "__main__":
             path = os.path.join(
                 username, dt, data["uuid"], version, data["original_filename"]
             )
-            _, size = upload_to_s3(image.url, bucket, path, {})
+            thumb_key = path.replace(f"/{version}/", "/thumb/")
+            image_data = fetch(image.url)
+            original = upload_executor.submit(
+                upload_to_s3, image_data, bucket, path, existing_s3_objects
+            )
+            thumb = upload_executor.submit(
+                upload_and_resize, image_data, bucket, thumb_key, existing_s3_objects
+            )
+
+            size = original.result()
             data["versions"].append(
                 dict(
                     version=version,
@@ -301,8 +370,7 @@ if __name__ == "__main__":
                 )
             )
 
-            thumb_key = path.replace(f"/{version}/", "/thumb/")
-            uploaded_image, size = upload_and_resize(image.url, bucket, thumb_key, {})
+            uploaded_image, size = thumb.result()
             data["versions"].append(
                 dict(
                     version="thumb",
@@ -315,12 +383,11 @@ if __name__ == "__main__":
                 )
             )
 
-            _, r = wrap(session, f"{base_url}/api/photos/", data, "POST")
-
-            if r.status_code == 400 and "this uuid already exists" in r.text:
+            if image.id in known:
                 existing += 1
 
                 if existing > args.stop_after:
+                    stop_reached = True
                     break
 
                 _, r = wrap(
@@ -329,9 +396,14 @@ if __name__ == "__main__":
                     data=data,
                     method="PATCH",
                 )
+            else:
+                _, r = wrap(session, f"{base_url}/api/photos/", data, "POST")
 
-            elif r.status_code > 399:
+            if r.status_code > 399:
                 print(r.status_code, r.text)
                 r.raise_for_status()
 
+        if stop_reached:
+            break
+
     print(i + 1, " photos", existing, " existing")
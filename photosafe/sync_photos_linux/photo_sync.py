@@ -1,20 +1,50 @@
 import argparse
-import json
+import concurrent.futures
+import functools
+import itertools
 import mimetypes
 import os
-import shutil
+import queue
 import sys
 
 import boto3
+import orjson
 import requests
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from pyicloud import PyiCloudService
-from tools import DateTimeEncoder, list_bucket
+from requests.adapters import HTTPAdapter
+from tools import existing_uuids, json_default, list_bucket, needs_upload
 from tqdm import tqdm
+from urllib3.util.retry import Retry
 
+upload_workers = 8
+part_threads = 4
+
+# upload_workers uploads of part_threads each share the client's connection
+# pool; downloads aren't seekable, so s3transfer buffers up to
+# max_in_memory_upload_chunks 8 MiB parts per upload
 s3 = boto3.client(
     "s3",
     "us-west-2",
+    config=Config(
+        max_pool_connections=upload_workers * part_threads,
+        retries={"mode": "adaptive", "max_attempts": 5},
+    ),
+)
+transfer_config = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=part_threads,
+    max_in_memory_upload_chunks=part_threads,
+    use_threads=True,
 )
+upload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=upload_workers)
+
+# one progress bar line per concurrent upload
+bar_positions = queue.SimpleQueue()
+for position in range(upload_workers):
+    bar_positions.put(position)
 
 bucket = os.environ.get("BUCKET", "jmelloy-photo-backup")
 base_url = os.environ.get("BASE_URL", "https://api.photosafe.melloy.life")
@@ -31,6 +61,28 @@ r = requests.get(f"{base_url}/users/me", headers={"Authorization": f"Token {toke
 r.raise_for_status()
 user = r.json()
 
+# retry everything but the POSTs that create photos and albums; exists_batch
+# only reads, so it gets its own adapter that may replay a POST
+retry = Retry(
+    total=3,
+    backoff_factor=0.3,
+    status_forcelist=(500, 502, 503, 504),
+    allowed_methods=frozenset({"GET", "HEAD", "OPTIONS", "PUT", "PATCH", "DELETE"}),
+)
+session = requests.Session()
+session.mount(
+    base_url, HTTPAdapter(pool_connections=1, pool_maxsize=8, max_retries=retry)
+)
+session.mount(
+    f"{base_url}/api/photos/exists_batch/",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=8,
+        max_retries=retry.new(allowed_methods=frozenset({"POST"})),
+    ),
+)
+session.headers.update({"Authorization": f"Token {token}"})
+
 icloud_username = os.environ.get("ICLOUD_USERNAME") or input("Username: ")
 icloud_password = os.environ.get("ICLOUD_PASSWORD") or input("Password: ")
 api = PyiCloudService(icloud_username, icloud_password)
@@ -78,54 +130,95 @@ elif api.requires_2sa:
         sys.exit(1)
 
 
+@functools.lru_cache(maxsize=64)
+def get_content_type(suffix):
+    if suffix == ".heic":
+        return "image/heic"
+    return mimetypes.types_map.get(suffix) or "application/octet-stream"
+
+
 def upload_photo(photo, version, path):
-    os.makedirs(os.path.split(path)[0], exist_ok=True)
     r = photo.download(version)
     r.raise_for_status()
+    # store the decoded bytes, so the S3 size matches the iCloud version size
+    r.raw.decode_content = True
     size = photo.versions[version]["size"]
 
-    with open(path, "wb") as FILE:
-        shutil.copyfileobj(r.raw, FILE)
-
     # print(f"Uploading {path} to {bucket} ({size} b")
 
-    suffix = os.path.splitext(path)[-1].lower()
-    content_type = mimetypes.types_map.get(suffix)
-    if suffix == ".heic":
-        content_type = "image/heic"
-    if not content_type:
-        content_type = "application/octet-stream"
-
-    with tqdm(
-        total=size,
-        desc=f"{path}",
-        bar_format="{percentage:.1f}%|{bar:25} | {rate_fmt} | {desc}",
-        unit="B",
-        unit_scale=True,
-        unit_divisor=1024,
-    ) as pbar:
-        s3.upload_file(
-            path,
-            bucket,
-            path,
-            ExtraArgs=dict(ContentType=content_type),
-            Callback=pbar.update,
-        )
-    os.remove(path)
+    content_type = get_content_type(os.path.splitext(path)[-1].lower())
+
+    position = bar_positions.get()
+    try:
+        with tqdm(
+            total=size,
+            desc=f"{path}",
+            bar_format="{percentage:.1f}%|{bar:25} | {rate_fmt} | {desc}",
+            unit="B",
+            unit_scale=True,
+            unit_divisor=1024,
+            position=position,
+            leave=False,
+        ) as pbar:
+            s3.upload_fileobj(
+                r.raw,
+                bucket,
+                path,
+                ExtraArgs=dict(ContentType=content_type),
+                Callback=pbar.update,
+                Config=transfer_config,
+            )
+    finally:
+        bar_positions.put(position)
 
 
 _albums = {}
 
 
+def load_albums(*album_names):
+    for album_name in album_names:
+        print(f"Loading album {album_name}")
+        _albums[album_name] = frozenset(
+            p.id for p in api.photos.albums.get(album_name, [])
+        )
+
+
 def album_contains(album_name, photo):
-    if album_name in _albums:
-        return photo.id in _albums[album_name]
-    photos = []
-    print(f"Loading album {album_name}")
-    for photo in api.photos.albums.get(album_name, []):
-        photos.append(photo.id)
-    _albums[album_name] = photos
-    return photo.id in photos
+    if album_name not in _albums:
+        load_albums(album_name)
+    return photo.id in _albums[album_name]
+
+
+# photo flags backed by membership of an iCloud smart album
+SMART_ALBUMS = {
+    "screenshot": "Screenshots",
+    "slow_mo": "Slo-mo",
+    "time_lapse": "Time-lapse",
+    "panorama": "Panoramas",
+    "burst": "Bursts",
+    "portrait": "Portrait",
+}
+
+
+def album_flags(photo):
+    return {
+        flag: album_contains(album_name, photo)
+        for flag, album_name in SMART_ALBUMS.items()
+    }
+
+
+def with_existence(records, chunk_size=500):
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            return
+
+        known = existing_uuids(
+            session, base_url, [p._asset_record["recordName"] for p in chunk]
+        )
+        for photo in chunk:
+            yield photo, photo._asset_record["recordName"] in known
 
 
 def upload_albums():
@@ -139,33 +232,24 @@ def upload_albums():
             "title": album.title,
             "creation_date": album.created,
         }
-        album_info["photos"] = list(
-            map(
-                lambda photo: photo._asset_record["recordName"],
-                album.photos,
-            )
-        )
+        album_info["photos"] = [
+            photo._asset_record["recordName"] for photo in album.photos
+        ]
 
         if not album_info["photos"]:
             continue
 
-        r = requests.put(
+        r = session.put(
             f"{base_url}/api/albums/{album.id}/",
-            data=json.dumps(album_info, cls=DateTimeEncoder),
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Token {token}",
-            },
+            data=orjson.dumps(album_info, default=json_default),
+            headers={"Content-Type": "application/json"},
         )
 
         if r.status_code == 404:
-            r = requests.post(
+            r = session.post(
                 f"{base_url}/api/albums/",
-                data=json.dumps(album_info, cls=DateTimeEncoder),
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": f"Token {token}",
-                },
+                data=orjson.dumps(album_info, default=json_default),
+                headers={"Content-Type": "application/json"},
             )
 
         if r.status_code >= 400:
@@ -175,35 +259,38 @@ def upload_albums():
 
 if __name__ == "__main__":
     s3_keys = {}
+    max_cached_months = 12
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--stop-after", type=int, default=1000)
     parser.add_argument("--offset", type=int, default=0)
 
     args = parser.parse_args()
-    os.makedirs(api_username, exist_ok=True)
+    load_albums(*SMART_ALBUMS.values())
     for library_name, library in api.photos.libraries.items():
         print(f"Library: {library_name}")
         existing = 0
 
-        for i, photo in enumerate(library.all.fetch_records(args.offset)):
+        records = with_existence(library.all.fetch_records(args.offset))
+        for i, (photo, exists) in enumerate(records):
             print(photo, photo.created)
             dt = (photo.asset_date or photo.created).strftime("%Y/%m/%d")
 
-            objects = s3_keys.get(dt)
-            if not objects:
+            month = dt[0:7]
+            objects = s3_keys.get(month)
+            if objects is None:
                 objects = {
-                    x[0]: x[1]
-                    for x in list_bucket(
-                        s3,
-                        bucket=bucket,
-                        prefix=os.path.join(os.path.join(api_username, dt)),
+                    key: size
+                    for key, size, _ in list_bucket(
+                        s3, bucket=bucket, prefix=f"{api_username}/{month}/"
                     )
                 }
-                s3_keys[dt] = objects
+                s3_keys[month] = objects
                 for key in list(s3_keys):
-                    if key[0:7] > dt[0:7]:
+                    if key > month:
                         del s3_keys[key]
+                if len(s3_keys) > max_cached_months:
+                    s3_keys.pop(next(iter(s3_keys)))
                 # print(sys.getsizeof(), "bytes")
 
             exif = None
@@ -231,12 +318,7 @@ if __name__ == "__main__":
                 "live_photo": "live" in photo.versions,
                 "isphoto": photo.item_type == "image",
                 "ismovie": photo.item_type == "movie",
-                "screenshot": album_contains("Screenshots", photo),
-                "slow_mo": album_contains("Slo-mo", photo),
-                "time_lapse": album_contains("Time-lapse", photo),
-                "panorama": album_contains("Panoramas", photo),
-                "burst": album_contains("Bursts", photo),
-                "portrait": album_contains("Portrait", photo),
+                **album_flags(photo),
                 "library": library_name,
                 "fields": photo.fields,
             }
@@ -248,12 +330,12 @@ if __name__ == "__main__":
                 "live": "s3_live_path",
             }
 
+            prefix = f"{api_username}/{dt}/{data['uuid']}"
+            needed = []
             for version, details in photo.versions.items():
-                path = os.path.join(
-                    api_username, dt, data["uuid"], version, details["filename"]
-                )
-                if path not in objects or objects[path] != details["size"]:
-                    upload_photo(photo, version, path)
+                path = f"{prefix}/{version}/{details['filename']}"
+                if needs_upload(objects, path, details["size"]):
+                    needed.append((version, path))
                 if version in keys:
                     data[keys[version]] = path
 
@@ -269,34 +351,33 @@ if __name__ == "__main__":
                     )
                 )
 
-            r = requests.post(
-                f"{base_url}/api/photos/",
-                data=json.dumps(data, cls=DateTimeEncoder),
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": f"Token {token}",
-                },
-            )
+            for future in [
+                upload_executor.submit(upload_photo, photo, version, path)
+                for version, path in needed
+            ]:
+                future.result()
 
-            if r.status_code == 400 and "this uuid already exists" in r.text:
+            if exists:
                 existing += 1
 
                 if existing > args.stop_after:
                     break
 
-                r = requests.patch(
+                r = session.patch(
                     f"{base_url}/api/photos/{data['uuid']}/",
-                    data=json.dumps(data, cls=DateTimeEncoder),
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": f"Token {token}",
-                    },
+                    data=orjson.dumps(data, default=json_default),
+                    headers={"Content-Type": "application/json"},
+                )
+            else:
+                r = session.post(
+                    f"{base_url}/api/photos/",
+                    data=orjson.dumps(data, default=json_default),
+                    headers={"Content-Type": "application/json"},
                 )
 
-            elif r.status_code > 399:
+            if r.status_code > 399:
                 print(r.status_code, r.text)
                 r.raise_for_status()
 
-    shutil.rmtree(api_username)
     print(i + 1, " photos", existing, " existing")
     upload_albums()
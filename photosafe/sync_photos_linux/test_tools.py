@@ -0,0 +1,17 @@
+from tools import needs_upload
+
+
+def test_needs_upload_missing_key():
+    assert needs_upload({}, "user/2023/01/01/uuid/original/a.heic", 10)
+
+
+def test_needs_upload_size_mismatch():
+    key = "user/2023/01/01/uuid/original/a.heic"
+
+    assert needs_upload({key: 4}, key, 10)
+
+
+def test_needs_upload_same_size():
+    key = "user/2023/01/01/uuid/original/a.heic"
+
+    assert not needs_upload({key: 10}, key, 10)
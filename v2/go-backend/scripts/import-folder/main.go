@@ -6,6 +6,7 @@ import (
 	"flag"
 	"fmt"
 	"io"
+	"io/fs"
 	"log"
 	"mime/multipart"
 	"net/http"
@@ -46,14 +47,17 @@ func main() {
 
 	log.Printf("Scanning folder: %s", folderPath)
 
-	// Walk through the directory and process each file
-	err := filepath.Walk(folderPath, func(path string, info os.FileInfo, err error) error {
+	metaCache := map[string]map[string]interface{}{}
+
+	// Walk through the directory and process each file; WalkDir avoids an
+	// lstat per entry that filepath.Walk does to build os.FileInfo
+	err := filepath.WalkDir(folderPath, func(path string, d fs.DirEntry, err error) error {
 		if err != nil {
 			return fmt.Errorf("error accessing path %q: %v", path, err)
 		}
 
 		// Skip directories
-		if info.IsDir() {
+		if d.IsDir() {
 			return nil
 		}
 
@@ -62,10 +66,15 @@ func main() {
 			fmt.Printf("Skipping non-image file: %s\n", path)
 			return nil
 		}
-		// Attempt to read metadata from meta.json
-		metaData, err := readMetaJSON(filepath.Dir(path))
-		if err != nil {
-			log.Printf("Error reading metadata for %s: %s", path, err)
+		// Attempt to read metadata from meta.json, once per directory
+		dir := filepath.Dir(path)
+		metaData, ok := metaCache[dir]
+		if !ok {
+			metaData, err = readMetaJSON(dir)
+			if err != nil {
+				log.Printf("Error reading metadata for %s: %s", dir, err)
+			}
+			metaCache[dir] = metaData
 		}
 
 		assetFields := map[string]string{
@@ -88,15 +97,13 @@ func main() {
 	log.Println("Processing completed!")
 }
 
+var imageExtensions = map[string]struct{}{
+	".jpg": {}, ".jpeg": {}, ".png": {}, ".gif": {}, ".bmp": {}, ".tiff": {}, ".webp": {}, ".heic": {},
+}
+
 func isImageFile(path string) bool {
-	extensions := []string{".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff", ".webp", ".heic"}
-	ext := strings.ToLower(filepath.Ext(path))
-	for _, validExt := range extensions {
-		if ext == validExt {
-			return true
-		}
-	}
-	return false
+	_, ok := imageExtensions[strings.ToLower(filepath.Ext(path))]
+	return ok
 }
 
 func readMetaJSON(folderPath string) (map[string]interface{}, error) {
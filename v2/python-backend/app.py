@@ -18,6 +18,7 @@ def get_exif_data(image):
     try:
         exif = image.getexif()
         if exif:
+            # /thumbnail returns every IFD0 tag; callers keep them as free-form metadata
             for tag, value in exif.items():
                 decoded_tag = TAGS.get(tag, tag)
                 exif_data[decoded_tag] = value